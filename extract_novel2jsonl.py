@@ -1,13 +1,37 @@
-import json
 import os
 import re
 import shutil
-import zipfile
-import rarfile
+import libarchive
+import orjson
+from charset_normalizer import from_bytes
 import argparse
+from itertools import islice
+from multiprocessing import Pool
 
 MIN_CHAPTERS = 10  # 固定最小章节数要求
 
+# 预编译的正则表达式，避免逐行重复编译
+_NUMBER = r'[零一二三四五六七八九十百千万\d]+'
+# 单独的卷名行，需整行匹配
+_VOLUME = rf"[【\[]*(?:第{_NUMBER}卷|卷{_NUMBER})(?:[：:\s]\s*\S+)?[】\]]*$"
+# 与 str.splitlines() 相同的换行字符
+_BREAKS = r"\r\n\x0b\x0c\x1c-\x1e\x85\u2028\u2029"
+_INLINE_SPACE = rf"[^\S{_BREAKS}]"  # 不含换行的空白
+# 章节标题只在行首出现，前面允许开括号和一个长度有限的前缀：
+# 卷标题（“第一卷 风起 第一章”“VIP卷 第一章”）、“正文”或英文“Chapter N”
+# 前缀不得跨行，否则行首的卷名会一直扫描到下一个“章”或文件末尾
+_CHAPTER_PREFIX = rf"(?:(?:第{_NUMBER}卷|卷{_NUMBER})[^章节{_BREAKS}]*?|\S{{0,8}}卷{_INLINE_SPACE}*|正文{_INLINE_SPACE}*|(?i:chapter){_INLINE_SPACE}*\d+{_INLINE_SPACE}*)"
+_CHAPTER = rf"[【\[（(]*{_CHAPTER_PREFIX}?[【\[（(]*(?:第{_NUMBER}[章节]|[章节]{_NUMBER})"
+# 对已去除首尾空白的行做一次 match 即完成分类：vol 为卷名行，ch 为章节行
+_LINE_CLASS_RE = re.compile(rf"(?P<vol>{_VOLUME})|(?P<ch>{_CHAPTER})")
+# 全文中位于行首（允许前导空白）的章节标题，用于逐行处理前估计章节数上限
+_CHAPTER_LINE_RE = re.compile(rf"(?<![^{_BREAKS}]){_INLINE_SPACE}*{_CHAPTER}")
+_TRAILING_EQ = re.compile(r'^=+')
+# 广告和作者注；ps 两侧不能紧挨英文字母，避免误删 helps、psychology 之类的正文
+_AD_RE = re.compile(r'www\.|(?<![a-z])ps(?![a-z])', re.IGNORECASE)
+# 与 str.splitlines() 相同的换行符集合
+_LINE_BREAK_RE = re.compile(rf'\r\n|[{_BREAKS}]')
+
 
 def clean_text(text):
     """
@@ -22,51 +46,59 @@ def detect_and_decode(content_bytes):
     检测并解码二进制内容
     返回解码后的文本，如果都失败则返回 None
     """
+    # 绝大多数文件是 gb18030，先严格解码走快速路径
+    try:
+        return content_bytes.decode('gb18030')
+    except UnicodeDecodeError:
+        pass
+
     try:
+        result = from_bytes(content_bytes, cp_isolation=['gb18030', 'utf_8', 'utf_16', 'big5', 'gbk']).best()
+        if result is not None:
+            print(f"[INFO] gb18030 解码失败，自动检测为 {result.encoding}")
+            return clean_text(str(result))
+
         text = content_bytes.decode('gb18030', errors='replace')
-        if '�' in text:
-            if text.count('�') > 100:
-                print(f"[WARN] gb18030 解码发现大量无效字符 ({text.count('�')}个)，尝试其他编码")
-                try:
-                    return content_bytes.decode('utf-8')
-                except UnicodeDecodeError:
-                    print("[INFO] UTF-8 解码失败，继续尝试其他编码")
-                try:
-                    return content_bytes.decode('utf-16')
-                except UnicodeDecodeError:
-                    print("[INFO] UTF-16 解码失败，尝试自动检测")
-            else:
-                print(f"[INFO] 使用 gb18030 解码，包含少量替换字符 ({text.count('�')}个)")
+        bad = text.count('\ufffd')
+        print(f"[WARN] 自动检测编码失败，使用 gb18030 解码，包含替换字符 ({bad}个)")
         return clean_text(text)
     except Exception as e:
-        print(f"[ERROR] gb18030 解码失败: {str(e)}")
+        print(f"[ERROR] 解码失败: {str(e)}")
         return None
 
 
+def read_first_txt(file_path):
+    """
+    读取压缩包中第一个 txt 文件的字节内容，没有则返回 None
+    zip、rar 统一由 libarchive 流式解压，不再调用外部 unrar
+    """
+    # Windows 上打包的中文压缩包文件名多为不带 UTF-8 标记的 GBK 编码
+    with libarchive.file_reader(file_path, header_codec='gb18030') as archive:
+        for entry in archive:
+            name = entry.pathname
+            # 文件名仍无法解码时 pathname 为 bytes
+            suffix = b".txt" if isinstance(name, bytes) else ".txt"
+            if entry.isfile and name.lower().endswith(suffix):
+                return b''.join(entry.get_blocks())
+    return None
+
+
 def process_compressed_file(file_path):
     """
     处理压缩文件中的小说内容
     """
     ext = os.path.splitext(file_path)[1].lower()
 
+    if ext not in (".zip", ".rar"):
+        print(f"[ERROR] 不支持的压缩格式: {ext}")
+        return None
+
     try:
-        if ext == ".zip":
-            with zipfile.ZipFile(file_path, 'r') as z:
-                txt_files = [name for name in z.namelist() if name.lower().endswith(".txt")]
-                if not txt_files:
-                    print(f"[WARN] {file_path} 内没有 txt 文件")
-                    return None
-                content = detect_and_decode(z.read(txt_files[0]))
-        elif ext == ".rar":
-            with rarfile.RarFile(file_path, 'r') as r:
-                txt_files = [name for name in r.namelist() if name.lower().endswith(".txt")]
-                if not txt_files:
-                    print(f"[WARN] {file_path} 内没有 txt 文件")
-                    return None
-                content = detect_and_decode(r.read(txt_files[0]))
-        else:
-            print(f"[ERROR] 不支持的压缩格式: {ext}")
+        content_bytes = read_first_txt(file_path)
+        if content_bytes is None:
+            print(f"[WARN] {file_path} 内没有 txt 文件")
             return None
+        content = detect_and_decode(content_bytes)
     except Exception as e:
         print(f"[ERROR] 处理 {file_path} 时出错：{e}")
         return None
@@ -92,56 +124,38 @@ def process_txt_file(file_path):
         return None
 
 
-def check_line_type(line):
-    """
-    检查行的类型
-    返回值：
-    - 0: 普通行
-    - 1: 单独的卷名行（需要忽略）
-    - 2: 包含章节名的行（需要替换为回车）
-    """
-    number_pattern = r'(?:(?:[零一二三四五六七八九十百千万\d]+)|(?:\d+))'
-
-    # 卷标题模式
-    volume_pattern = f"^[【\[]*(?:第{number_pattern}卷|卷{number_pattern})(?:[：:\s]\s*\S+)?[】\]]*$"
-
-    # 章节标题模式（包括可能的卷标题前缀）
-    chapter_pattern = f"第{number_pattern}[章节]|[章节]{number_pattern}"
-
-    # 先检查是否是纯卷标题
-    if re.match(volume_pattern, line.strip()):
-        return 1
-
-    # 再检查是否包含章节标题
-    if re.search(chapter_pattern, line.strip()):
-        return 2
-
-    return 0
-
-
 def process_content(content):
     """
     处理小说文本内容
     """
-    lines = content.splitlines()
+    # 一次正则扫描得到章节数上限，明显不足的文件不再逐行处理
+    chapter_bound = sum(1 for _ in islice(_CHAPTER_LINE_RE.finditer(content), MIN_CHAPTERS + 1))
+    if chapter_bound <= MIN_CHAPTERS:
+        print(f"[WARN] 章节数({chapter_bound})不足最小要求({MIN_CHAPTERS})")
+        return None
+
+    # 只切出前20行用于定位开头，其余部分保持为一整段字符串
+    head = _LINE_BREAK_RE.split(content, maxsplit=20)
 
     # 去除开头
+    # 从第20行倒序扫描，"正文"优先于"简介"
     header_index = None
-    limit = min(20, len(lines))
-    indices = [i for i in range(limit) if "正文" in lines[i]]
-    if indices:
-        header_index = max(indices)
-    else:
-        indices = [i for i in range(limit) if "简介" in lines[i]]
-        if indices:
-            header_index = max(indices)
+    intro_index = None
+    for i in range(min(20, len(head)) - 1, -1, -1):
+        if "正文" in head[i]:
+            header_index = i
+            break
+        if intro_index is None and "简介" in head[i]:
+            intro_index = i
+    if header_index is None:
+        header_index = intro_index
     if header_index is not None:
-        lines = lines[header_index + 1:]
+        body = "\n".join(head[header_index + 1:])
     else:
-        lines = lines[10:] if len(lines) > 10 else []
+        body = "\n".join(head[10:]) if len(head) > 10 else ""
 
     # 去除广告和作者注
-    lines = [line for line in lines if "www." not in line.lower() and "ps" not in line.lower()]
+    lines = [line for line in body.splitlines() if not _AD_RE.search(line)]
 
     # 去除末尾
     candidate = None
@@ -151,12 +165,11 @@ def process_content(content):
             candidate = i
             break
     if candidate is not None:
-        if re.match(r"^=+", lines[candidate].strip()):
-            remove_indices = {candidate, candidate - 1, candidate - 2}
-            lines = [line for idx, line in enumerate(lines) if idx not in remove_indices]
+        if _TRAILING_EQ.match(lines[candidate].strip()):
+            del lines[max(0, candidate - 2):candidate + 1]
 
     # 处理每行
-    processed_lines = []
+    out = []
     chapter_count = 0
 
     for line in lines:
@@ -164,41 +177,49 @@ def process_content(content):
         if sline == "":
             continue
 
-        line_type = check_line_type(sline)
-        if line_type == 1:  # 单独的卷名行，直接忽略
+        m = _LINE_CLASS_RE.match(sline)
+        if m is None:  # 普通行
+            out.append(sline)
+        elif m.lastgroup == "vol":  # 单独的卷名行，直接忽略
             continue
-        elif line_type == 2:  # 包含章节名的行，替换为回车
-            processed_lines.append(("", True))
+        else:  # 包含章节名的行，替换为回车
+            out.append("")
             chapter_count += 1
-        else:  # 普通行
-            new_line = re.sub(r'^\s+', '', sline) if re.match(r'^\s+', sline) else sline
-            processed_lines.append((new_line, False))
 
     if chapter_count <= MIN_CHAPTERS:
         print(f"[WARN] 章节数({chapter_count})不足最小要求({MIN_CHAPTERS})")
         return None
 
-    final_lines = [text for text, is_marker in processed_lines]
-    final_text = "\n".join(final_lines)
+    final_text = "\n".join(out)
     return clean_text(final_text)
 
 
-def process_directory(source_dir, output_file, move_folder):
+def _process_archive(file_path):
+    """
+    在子进程中处理单个压缩文件，返回 (文件路径, 文本或 None)
+    """
+    print(f"[INFO] 正在处理：{file_path}")
+    return file_path, process_compressed_file(file_path)
+
+
+def process_directory(source_dir, output_file, move_folder, jobs=None):
     """
     处理目录中的所有小说文件
+    各文件相互独立，用多进程并行处理，结果只在主进程中写出
+    jobs 默认为 CPU 核数；源目录在慢速挂载盘上时可适当调大，让读盘与解析重叠
     """
     if not os.path.exists(move_folder):
         os.makedirs(move_folder)
 
-    with open(output_file, "w", encoding="utf-8") as out_f:
-        for file_name in os.listdir(source_dir):
-            if not file_name.lower().endswith((".zip", ".rar")):
-                continue
-            file_path = os.path.join(source_dir, file_name)
-            print(f"[INFO] 正在处理：{file_path}")
-            text = process_compressed_file(file_path)
+    with os.scandir(source_dir) as it:
+        file_paths = [entry.path for entry in it
+                      if entry.name[-4:].lower() in (".zip", ".rar") and entry.is_file()]
+
+    # 1 MiB 写缓冲，减少逐条写记录时的系统调用
+    with open(output_file, "wb", buffering=1 << 20) as out_f, Pool(jobs or os.cpu_count()) as pool:
+        for file_path, text in pool.imap_unordered(_process_archive, file_paths, chunksize=4):
             if text is None:
-                dest = os.path.join(move_folder, file_name)
+                dest = os.path.join(move_folder, os.path.basename(file_path))
                 try:
                     shutil.copy(file_path, dest)
                     print(f"[INFO] 已将文件复制到 {dest}")
@@ -206,7 +227,8 @@ def process_directory(source_dir, output_file, move_folder):
                     print(f"[ERROR] 移动文件时出错：{e}")
                 continue
             obj = {"text": text}
-            out_f.write(json.dumps(obj, ensure_ascii=False) + "\n")
+            out_f.write(orjson.dumps(obj))
+            out_f.write(b"\n")
 
 
 def append_to_jsonl(input_file, output_file):
@@ -229,10 +251,11 @@ def append_to_jsonl(input_file, output_file):
     if text is None:
         return
 
-    mode = 'a' if os.path.exists(output_file) else 'w'
-    with open(output_file, mode, encoding="utf-8") as out_f:
+    mode = 'ab' if os.path.exists(output_file) else 'wb'
+    with open(output_file, mode) as out_f:
         obj = {"text": text}
-        out_f.write(json.dumps(obj, ensure_ascii=False) + "\n")
+        out_f.write(orjson.dumps(obj))
+        out_f.write(b"\n")
     print(f"[INFO] 已追加到 {output_file}")
 
 
@@ -245,6 +268,7 @@ def main():
     dir_parser.add_argument('-s', '--source', required=True, help='源文件目录')
     dir_parser.add_argument('-o', '--output', required=True, help='输出的JSONL文件')
     dir_parser.add_argument('-m', '--move', required=True, help='章节数不足的文件移动目录')
+    dir_parser.add_argument('-j', '--jobs', type=int, default=None, help='并行进程数（默认CPU核数）')
 
     # 追加文件的命令
     append_parser = subparsers.add_parser('append', help='将单个文件追加到JSONL')
@@ -254,7 +278,7 @@ def main():
     args = parser.parse_args()
 
     if args.command == 'process-dir':
-        process_directory(args.source, args.output, args.move)
+        process_directory(args.source, args.output, args.move, args.jobs)
         print("[INFO] 目录处理完毕！")
     elif args.command == 'append':
         append_to_jsonl(args.input, args.output)
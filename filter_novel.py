@@ -1,8 +1,17 @@
 import os
 import shutil
 import xlrd
+import numpy as np
 import re
 
+# Decorators and whitespace stripped from titles before matching; the whitespace
+# is exactly the set matched by re's \s (every character where str.isspace() holds)
+_STRIP = str.maketrans('', '', '《》（）()：:'
+                       '\t\n\x0b\x0c\r\x1c\x1d\x1e\x1f \x85\xa0\u1680\u2000\u2001\u2002\u2003\u2004'
+                       '\u2005\u2006\u2007\u2008\u2009\u200a\u2028\u2029\u202f\u205f\u3000')
+# Title part of a filename, before the author in parentheses
+_TITLE_RE = re.compile(r'[《]?(.+?)[》]?(?:（|[\(])')
+
 
 def read_novel_data(xls_path):
     """Read and process novel ratings from XLS file."""
@@ -18,32 +27,39 @@ def read_novel_data(xls_path):
     kucao_idx = headers.index('KuCao')
     ducao_idx = headers.index('DuCao')
 
-    qualified_novels = set()
-
-    # Process each row starting from row 1 (skipping header)
-    for row_idx in range(1, worksheet.nrows):
-        title = worksheet.cell_value(row_idx, title_idx)
-        xiancao = float(worksheet.cell_value(row_idx, xiancao_idx) or 0)
-        liangcao = float(worksheet.cell_value(row_idx, liangcao_idx) or 0)
-        gancao = float(worksheet.cell_value(row_idx, gancao_idx) or 0)
-        kucao = float(worksheet.cell_value(row_idx, kucao_idx) or 0)
-        ducao = float(worksheet.cell_value(row_idx, ducao_idx) or 0)
+    # Pull whole columns at once (skipping header) and evaluate criteria with NumPy
+    def ratings(col_idx):
+        return np.array([value or 0 for value in worksheet.col_values(col_idx, 1)], dtype=float)
 
-        total_ratings = xiancao + liangcao + gancao + kucao + ducao
-        xiancao_ratio = xiancao / total_ratings if total_ratings > 0 else 0
+    titles = worksheet.col_values(title_idx, 1)
+    xiancao = ratings(xiancao_idx)
+    total_ratings = xiancao + ratings(liangcao_idx) + ratings(gancao_idx) + ratings(kucao_idx) + ratings(ducao_idx)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xiancao_ratio = np.where(total_ratings > 0, xiancao / total_ratings, 0)
 
-        # Check if novel meets either criteria
-        if (total_ratings > 400) or (total_ratings <= 400 and xiancao_ratio > 0.6 and xiancao > 10):
-            qualified_novels.add(title)
+    # Check if novel meets either criteria
+    mask = (total_ratings > 400) | ((total_ratings <= 400) & (xiancao_ratio > 0.6) & (xiancao > 10))
+    qualified_novels = {title for title, ok in zip(titles, mask) if ok}
 
     return qualified_novels
 
 
 def normalize_title(title):
     """Convert title to lowercase and remove common decorators for matching."""
-    # Remove common decorators and whitespace
-    title = re.sub(r'[《》（）()：:\s]', '', title.lower())
-    return title
+    return title.lower().translate(_STRIP)
+
+
+def link_or_copy(source_path, dest_path):
+    """Hardlink the file when on the same filesystem, otherwise fall back to a copy."""
+    try:
+        os.link(source_path, dest_path)
+    except FileExistsError:
+        if os.path.samefile(source_path, dest_path):
+            return  # Already linked by a previous run
+        os.unlink(dest_path)
+        link_or_copy(source_path, dest_path)
+    except OSError:
+        shutil.copy2(source_path, dest_path)
 
 
 def copy_matching_files(source_dir, dest_dir, qualified_novels):
@@ -58,13 +74,13 @@ def copy_matching_files(source_dir, dest_dir, qualified_novels):
     for filename in os.listdir(source_dir):
         if filename.lower().endswith(('.rar', '.zip')):
             # Extract the title part before the author
-            title_match = re.match(r'[《]?(.+?)[》]?(?:（|[\(])', filename)
+            title_match = _TITLE_RE.match(filename)
             if title_match:
                 file_title = normalize_title(title_match.group(1))
                 if file_title in normalized_qualified:
                     source_path = os.path.join(source_dir, filename)
                     dest_path = os.path.join(dest_dir, filename)
-                    shutil.copy2(source_path, dest_path)
+                    link_or_copy(source_path, dest_path)
                     matched_count += 1
                     print(f"Copied: {filename}")
 
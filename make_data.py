@@ -3,6 +3,11 @@
 """
 用法示例：
     python make_data.py demo.jsonl 3 4096
+    python make_data.py demo.jsonl 3 4096 100   # 每100篇抽样验证一次分词结果
+    python make_data.py demo.jsonl 3 4096 0 8   # 最多用8个进程分词
+分词进程数默认为 CPU 核数。每个进程各需一个 tokenizer（约300MB内存）；
+fork 启动时复用主进程已建好的 tokenizer（写时复制共享），其他启动方式下每个进程各自重建（约2秒），
+核数多、内存紧张时请用 JOBS 限制进程数。
 优化功能：
   - 检查并使用已有的临时分词文件，避免重复分词
   - 保留临时分词文件以供后续使用
@@ -17,23 +22,36 @@
   - 混洗效果与原版一致
 """
 
-import json
 import math
-import random
+import mmap
 import sys
 import os
 import struct
 import numpy as np
+from multiprocessing import Pool
 from pathlib import Path
 
+# orjson 直接从 bytes 解析，明显快于标准库；未安装时退回 json
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    import json
+    _loads = json.loads
+
 # -------------------------------
 # 导入自定义模块
 # -------------------------------
 from tokenizer.rwkv_tokenizer import TRIE_TOKENIZER
 from src.binidx import MMapIndexedDataset
 
+VOCAB_PATH = "tokenizer/rwkv_vocab_v20230424.txt"
+
 tokenizer = None  # 全局变量，在main中初始化
 
+# .offsets 文件中每条记录的布局：8(offset) + 4(length)，小端、紧凑排列
+OFFSET_DTYPE = np.dtype([("offset", "<u8"), ("length", "<u4")])
+
 
 def index_file_path(prefix_path):
     return prefix_path + ".idx"
@@ -78,19 +96,29 @@ def check_temp_files(temp_prefix):
 # -------------------------------
 class TokenizedDatasetBuilder:
     def __init__(self, output_prefix):
-        self.token_file = open(f"{output_prefix}.tokens", "wb")
-        self.offset_file = open(f"{output_prefix}.offsets", "wb")
+        # 大缓冲区减少逐篇写入时的系统调用
+        self.token_file = open(f"{output_prefix}.tokens", "wb", buffering=4 * 1024 * 1024)
+        self.offset_path = f"{output_prefix}.offsets"
         self.current_offset = 0
         self.doc_count = 0
+        # offset记录先放在内存中按需倍增，finalize 时一次性写出
+        self._offsets = np.empty(1024, dtype=OFFSET_DTYPE)
+        # 复用的写缓冲区，写入后立即被文件对象复制，可以安全地反复使用
+        self._buf = bytearray(1 << 20)
 
     def add_tokens(self, tokens):
         # 写入token序列
-        token_bytes = struct.pack(f"<{len(tokens)}H", *tokens)
-        self.token_file.write(token_bytes)
-
-        # 写入该文档的offset和长度
-        offset_record = struct.pack("<QI", self.current_offset, len(tokens))
-        self.offset_file.write(offset_record)
+        n_bytes = len(tokens) * 2  # uint16 = 2 bytes
+        if n_bytes > len(self._buf):
+            self._buf = bytearray(n_bytes * 2)
+        np.frombuffer(self._buf, dtype="<u2", count=len(tokens))[:] = tokens
+        with memoryview(self._buf) as view:
+            self.token_file.write(view[:n_bytes])
+
+        # 记录该文档的offset和长度
+        if self.doc_count == len(self._offsets):
+            self._offsets = np.resize(self._offsets, 2 * len(self._offsets))
+        self._offsets[self.doc_count] = (self.current_offset, len(tokens))
 
         self.current_offset += len(tokens)
         self.doc_count += 1
@@ -100,7 +128,7 @@ class TokenizedDatasetBuilder:
 
     def finalize(self):
         self.token_file.close()
-        self.offset_file.close()
+        self._offsets[:self.doc_count].tofile(self.offset_path)
         return self.doc_count, self.current_offset
 
 
@@ -110,78 +138,167 @@ class TokenizedDatasetBuilder:
 class TokenizedDatasetReader:
     def __init__(self, prefix):
         self.token_file = open(f"{prefix}.tokens", "rb")
-        self.offset_file = open(f"{prefix}.offsets", "rb")
-
-        # 读取所有文档的offset信息到内存
-        self.doc_offsets = []
-        while True:
-            offset_bytes = self.offset_file.read(12)  # 8(offset) + 4(length)
-            if not offset_bytes:
-                break
-            offset, length = struct.unpack("<QI", offset_bytes)
-            self.doc_offsets.append((offset, length))
+        # 只读映射整个token文件，随机访问时不再逐次 seek/read
+        self._mm = mmap.mmap(self.token_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mmap, "MADV_RANDOM"):
+            self._mm.madvise(mmap.MADV_RANDOM)
 
-    def get_doc_tokens(self, doc_idx):
-        offset, length = self.doc_offsets[doc_idx]
-        self.token_file.seek(offset * 2)  # uint16 = 2 bytes
-        token_bytes = self.token_file.read(length * 2)
-        return np.frombuffer(token_bytes, dtype=np.uint16)
+        # 一次性读取所有文档的offset信息到内存
+        self.doc_offsets = np.fromfile(f"{prefix}.offsets", dtype=OFFSET_DTYPE)
 
     def __len__(self):
         return len(self.doc_offsets)
 
     def close(self):
+        self._mm.close()
         self.token_file.close()
-        self.offset_file.close()
 
 
 # -------------------------------
 # MMapIndexedDatasetBuilder
 # -------------------------------
+IOV_MAX = 1024  # Linux 上单次 writev 最多提交的段数
+CONCAT_WINDOW = 1 << 30  # 不支持 writev 时，每次拼接写出的最大字节数
+
+
+def _writev_all(fd, view, starts, ends):
+    """用 writev 按顺序写出 view[starts[k]:ends[k]] 各段，处理部分写入的情况
+
+    切片按批创建，同一时刻最多只存在 IOV_MAX 个，内存占用与文档数无关
+    """
+    for i in range(0, len(starts), IOV_MAX):
+        batch = [view[s:e] for s, e in zip(starts[i:i + IOV_MAX].tolist(), ends[i:i + IOV_MAX].tolist())]
+        k = 0
+        while k < len(batch):
+            written = os.writev(fd, batch[k:])
+            while k < len(batch) and written >= batch[k].nbytes:
+                written -= batch[k].nbytes
+                k += 1
+            if written:
+                batch[k] = batch[k][written:]
+
+
 class MMapIndexedDatasetBuilder(object):
-    def __init__(self, out_file, dtype=np.uint16):
-        self._data_file = open(out_file, "wb")
+    def __init__(self, out_file, dtype=np.uint16, n_items=None):
+        self._data_file = open(out_file, "wb", buffering=4 * 1024 * 1024)
         self._dtype = dtype
-        self._sizes = []
+        # 条目数已知时一次性预分配 sizes，否则按需倍增
+        self._sizes = np.empty(n_items or 1024, dtype=np.int64)
+        self._n_items = 0
         self._doc_idx = [0]
 
-    def add_item(self, np_array):
-        assert np_array.dtype == self._dtype
-        self._data_file.write(np_array.tobytes(order="C"))
-        self._sizes.append(np_array.size)
-
-    def end_document(self):
-        self._doc_idx.append(len(self._sizes))
+    def _reserve(self, n):
+        need = self._n_items + n
+        if need > len(self._sizes):
+            sizes = np.empty(max(need, 2 * len(self._sizes)), dtype=np.int64)
+            sizes[:self._n_items] = self._sizes[:self._n_items]
+            self._sizes = sizes
+
+    def add_documents(self, buffer, byte_offsets, sizes):
+        """按给定顺序把 buffer 中的多篇文档原样写入，每篇文档只含一个item"""
+        itemsize = np.dtype(self._dtype).itemsize
+        if hasattr(os, "writev"):
+            # 先清空缓冲区，再用 writev 直接把各段写入文件，每次系统调用提交多篇文档
+            self._data_file.flush()
+            with memoryview(buffer) as view:
+                _writev_all(self._data_file.fileno(), view, byte_offsets, byte_offsets + sizes * itemsize)
+        else:
+            # 没有 writev 的平台：按窗口把各篇文档拼接成一整块再写出
+            tokens = np.frombuffer(buffer, dtype=self._dtype)
+            starts = (byte_offsets // itemsize).tolist()
+            counts = sizes.tolist()
+            ends = np.cumsum(sizes) * itemsize
+            i = 0
+            while i < len(counts):
+                window_end = (ends[i - 1] if i else 0) + CONCAT_WINDOW
+                j = max(i + 1, int(np.searchsorted(ends, window_end, side="right")))
+                self._data_file.write(np.concatenate([tokens[s:s + n] for s, n in zip(starts[i:j], counts[i:j])]))
+                i = j
+        base = self._n_items
+        self._reserve(len(sizes))
+        self._sizes[base:base + len(sizes)] = sizes
+        self._n_items += len(sizes)
+        self._doc_idx.extend(range(base + 1, self._n_items + 1))
 
     def finalize(self, index_file):
         self._data_file.close()
         with MMapIndexedDataset.Index.writer(index_file, self._dtype) as index:
-            index.write(self._sizes, self._doc_idx)
+            index.write(self._sizes[:self._n_items], self._doc_idx)
+
+
+# -------------------------------
+# 第一阶段的分词子进程
+# -------------------------------
+_worker_tokenizer = None  # 子进程使用的tokenizer
+_worker_verify_every = 0
+_worker_doc_count = 0
+
+
+def _init_tokenize_worker(vocab_path, verify_every):
+    global _worker_tokenizer, _worker_verify_every
+    # fork 出的子进程继承了主进程的 tokenizer，直接复用，免去每个进程重建一次
+    _worker_tokenizer = tokenizer if tokenizer is not None else TRIE_TOKENIZER(vocab_path)
+    _worker_verify_every = verify_every
+
+
+def _tokenize_line(line):
+    """对一行jsonl分词，返回带文档结束标记的token列表；需要跳过的行返回None"""
+    global _worker_doc_count
+    if not line.strip():
+        return None
+    try:
+        text = _loads(line)["text"]
+        tokens = _worker_tokenizer.encode(text)
+        if not tokens:
+            return None
+        _worker_doc_count += 1
+        # 抽样验证分词结果：每 verify_every 篇解码比对一次，0 表示不验证
+        if _worker_verify_every and _worker_doc_count % _worker_verify_every == 0:
+            if _worker_tokenizer.decode(tokens) != text:
+                print("ERROR: Tokenization verification failed!")
+                return None
+        tokens.append(0)  # 文档结束标记
+        return tokens
+    except Exception as e:
+        print(f"\nError processing document: {e}")
+        return None
 
 
 # -------------------------------
 # 质数检测函数
 # -------------------------------
+# 以前12个质数为底的确定性 Miller-Rabin，对 n < 318665857834031151167461（约3.18e23）结果准确
+_MR_BASES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37)
+
+
 def is_prime(n):
-    if n <= 1:
-        return False
-    if n <= 3:
-        return True
-    if n % 2 == 0 or n % 3 == 0:
+    if n < 2:
         return False
-    i = 5
-    while i * i <= n:
-        if n % i == 0 or n % (i + 2) == 0:
+    for p in _MR_BASES:
+        if n % p == 0:
+            return n == p
+    d = n - 1
+    s = 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+    for a in _MR_BASES:
+        x = pow(a, d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for _ in range(s - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
             return False
-        i += 6
     return True
 
 
 # -------------------------------
 # 主处理函数
 # -------------------------------
-def process_data(in_file, n_epoch):
-    global tokenizer
+def process_data(in_file, n_epoch, verify_every=0, jobs=None):
     prefix = Path(in_file).stem
     temp_prefix = f"{prefix}_temp"
     final_prefix = prefix
@@ -193,30 +310,21 @@ def process_data(in_file, n_epoch):
         print("### Found existing tokenization files, loading...")
         reader = TokenizedDatasetReader(temp_prefix)
         total_docs = len(reader)
-        total_tokens = reader.doc_offsets[-1][0] + reader.doc_offsets[-1][1]
+        total_tokens = int(reader.doc_offsets[-1]["offset"] + reader.doc_offsets[-1]["length"])
         reader.close()
         print(f"Loaded {total_docs} documents with {total_tokens} tokens")
     else:
         print("### Phase 1: One-time tokenization...")
         # 第一阶段：一次性分词
+        # 各文档互相独立，多进程并行分词；文档顺序无关紧要，第二阶段会混洗
+        # 每行往往就是一整部小说，逐行分发才能让各进程负载均衡
         builder = TokenizedDatasetBuilder(temp_prefix)
 
-        with open(in_file, 'r', encoding='utf-8') as f:
-            for line in f:
-                if not line.strip():
-                    continue
-                try:
-                    text = json.loads(line)["text"]
-                    tokens = tokenizer.encode(text)
-                    # 验证分词结果
-                    if tokenizer.decode(tokens) != text:
-                        print("ERROR: Tokenization verification failed!")
-                        continue
-                    tokens.append(0)  # 文档结束标记
+        with open(in_file, 'rb') as f, \
+                Pool(jobs, initializer=_init_tokenize_worker, initargs=(VOCAB_PATH, verify_every)) as pool:
+            for tokens in pool.imap_unordered(_tokenize_line, f, chunksize=1):
+                if tokens is not None:
                     builder.add_tokens(tokens)
-                except Exception as e:
-                    print(f"\nError processing document: {e}")
-                    continue
 
         total_docs, total_tokens = builder.finalize()
         print(f"\nTokenized {total_docs} documents, total tokens: {total_tokens}")
@@ -224,18 +332,16 @@ def process_data(in_file, n_epoch):
     print("\n### Phase 2: Shuffling and building final dataset...")
     # 第二阶段：随机混洗
     reader = TokenizedDatasetReader(temp_prefix)
-    final_builder = MMapIndexedDatasetBuilder(f"{final_prefix}.bin")
+    final_builder = MMapIndexedDatasetBuilder(f"{final_prefix}.bin", n_items=n_epoch * len(reader))
+
+    byte_offsets = reader.doc_offsets["offset"].astype(np.int64) * 2  # uint16 = 2 bytes
+    lengths = reader.doc_offsets["length"].astype(np.int64)
 
     for epoch in range(n_epoch):
         print(f"\nEpoch {epoch + 1}/{n_epoch}: shuffling documents")
-        # 只混洗文档索引
-        doc_indices = list(range(len(reader)))
-        random.shuffle(doc_indices)
-
-        for doc_idx in doc_indices:
-            tokens = reader.get_doc_tokens(doc_idx)
-            final_builder.add_item(tokens)
-            final_builder.end_document()
+        # 只混洗文档索引，按混洗后的顺序直接从映射内存写出
+        perm = np.random.permutation(len(reader))
+        final_builder.add_documents(reader._mm, byte_offsets[perm], lengths[perm])
 
     final_builder.finalize(f"{final_prefix}.idx")
     reader.close()
@@ -247,23 +353,38 @@ def process_data(in_file, n_epoch):
     return total_tokens, total_docs
 
 
+# -------------------------------
+# 预览解码
+# -------------------------------
+def _safe_decode(tok, ids, n, tail=False):
+    """解码开头（或结尾）n 个token；切在多字节字符中间时多取1~2个token重试"""
+    for k in (n, n + 1, n + 2):
+        try:
+            return tok.decode(ids[-k:] if tail else ids[:k])
+        except Exception:
+            continue
+    return repr(ids[-n:] if tail else ids[:n])
+
+
 # -------------------------------
 # 主函数
 # -------------------------------
 if __name__ == "__main__":
     if len(sys.argv) < 4:
-        print("Usage: python make_data.py <input.jsonl> <N_EPOCH> <CTX_LEN>")
+        print("Usage: python make_data.py <input.jsonl> <N_EPOCH> <CTX_LEN> [VERIFY_EVERY] [JOBS]")
         exit(1)
 
     N_EPOCH = int(sys.argv[2].strip())
     IN_FILE = sys.argv[1].strip()
     CTX_LEN = int(sys.argv[3].strip())
+    VERIFY_EVERY = int(sys.argv[4].strip()) if len(sys.argv) > 4 else 0
+    JOBS = int(sys.argv[5].strip()) if len(sys.argv) > 5 else None
 
     # 初始化tokenizer
-    tokenizer = TRIE_TOKENIZER("tokenizer/rwkv_vocab_v20230424.txt")
+    tokenizer = TRIE_TOKENIZER(VOCAB_PATH)
 
     # 处理数据
-    total_tokens, total_docs = process_data(IN_FILE, N_EPOCH)
+    total_tokens, total_docs = process_data(IN_FILE, N_EPOCH, VERIFY_EVERY, JOBS)
 
     # 验证输出
     print("\n### Verifying result...")
@@ -281,21 +402,9 @@ if __name__ == "__main__":
         assert dix[-1] == 0
         dix = dix[:-1]
         if len(dix) > PREVIEW_LIMIT:
-            try:
-                print(tokenizer.decode(dix[:PREVIEW_LIMIT]))
-            except:
-                try:
-                    print(tokenizer.decode(dix[:PREVIEW_LIMIT + 1]))
-                except:
-                    print(tokenizer.decode(dix[:PREVIEW_LIMIT + 2]))
+            print(_safe_decode(tokenizer, dix, PREVIEW_LIMIT))
             print("· " * 30)
-            try:
-                print(tokenizer.decode(dix[-PREVIEW_LIMIT:]))
-            except:
-                try:
-                    print(tokenizer.decode(dix[-PREVIEW_LIMIT - 1:]))
-                except:
-                    print(tokenizer.decode(dix[-PREVIEW_LIMIT - 2:]))
+            print(_safe_decode(tokenizer, dix, PREVIEW_LIMIT, tail=True))
         else:
             print(tokenizer.decode(dix))
 
@@ -304,13 +413,16 @@ if __name__ == "__main__":
     # 计算magic_prime
     if data_size >= CTX_LEN * 3:
         n_chunk = int(data_size // CTX_LEN) - 1
-        # 调整起始点，使得 start % 3 == 2
-        start = n_chunk - ((n_chunk - 2) % 3)
+        # 3k+2 形的质数除2外都是奇数，即形如6k+5；调整起始点使得 start % 6 == 5
+        start = n_chunk - ((n_chunk - 5) % 6)
         magic_prime = None
-        for i in range(start, 0, -3):  # 每次减3，只检查形如3k+2的数
+        for i in range(start, 0, -6):  # 每次减6，只检查形如6k+5的数
             if is_prime(i):
                 magic_prime = i
                 break
+        else:
+            if n_chunk >= 2:
+                magic_prime = 2
         if magic_prime:
             print(f"\n### magic_prime = {magic_prime} (for ctxlen {CTX_LEN})")
             print(f'\n--my_exit_tokens {data_size} --magic_prime {magic_prime} --ctx_len {CTX_LEN}\n')
@@ -1,6 +1,8 @@
 import json
 from pathlib import Path
 from collections import Counter
+
+import numpy as np
 from rwkv_tokenizer import TRIE_TOKENIZER
 
 
@@ -21,8 +23,8 @@ def analyze_tokens(vocab_path: str, jsonl_path: str):
     with open(vocab_path, 'r', encoding='utf-8') as f:
         original_lines = f.readlines()
 
-    # 创建token使用计数器
-    token_counter = Counter()
+    # 用定长数组统计token使用次数，处理完后再转换为Counter
+    counts = np.zeros(max(tokenizer.idx2token) + 1, dtype=np.int64)
 
     # 处理jsonl文件
     print("正在处理jsonl文件...")
@@ -32,7 +34,8 @@ def analyze_tokens(vocab_path: str, jsonl_path: str):
                 try:
                     text = json.loads(line)["text"]
                     tokens = tokenizer.encode(text)
-                    token_counter.update(tokens)
+                    arr = np.fromiter(tokens, dtype=np.int64, count=len(tokens))
+                    counts += np.bincount(arr, minlength=len(counts))
 
                     if line_num % 1000 == 0:
                         print(f"已处理 {line_num} 行")
@@ -40,6 +43,8 @@ def analyze_tokens(vocab_path: str, jsonl_path: str):
                     print(f"处理第 {line_num} 行时出错: {str(e)}")
                     continue
 
+    token_counter = Counter({idx: int(c) for idx, c in enumerate(counts) if c})
+
     # 获取使用过的token集合
     used_tokens = set(token_counter.keys())
     print(f"\n共发现 {len(used_tokens)} 个不同的token")
@@ -1,37 +1,23 @@
 import csv
+import mmap
 import re
 
+# 匹配每行的格式: 数字 '内容' 数字
+_TOKEN_LINE_RE = re.compile(rb"^(\d+)[^\S\n]+'(.*)'[^\S\n]+(\d+)", re.MULTILINE)
 
-def convert_token_file_to_csv(input_file, output_file):
-    # 用于存储转换后的数据
-    rows = []
-
-    # 读取输入文件
-    with open(input_file, 'r', encoding='utf-8') as f:
-        for line in f:
-            # 跳过空行
-            if not line.strip():
-                continue
-
-            # 使用正则表达式解析每行
-            # 匹配格式: 数字 '内容' 数字
-            match = re.match(r"(\d+)\s+'(.*)'\s+(\d+)", line)
 
-            if match:
-                index = match.group(1)  # 第一个数字
-                token = match.group(2)  # 引号中的内容
-                length = match.group(3)  # 第二个数字
-
-                # 将解析的数据添加到rows列表
-                rows.append([index, token, length])
-
-    # 将数据写入CSV文件
-    with open(output_file, 'w', encoding='utf-8', newline='') as f:
-        writer = csv.writer(f)
+def convert_token_file_to_csv(input_file, output_file):
+    # 映射输入文件，整个文件做一次正则扫描，结果直接流式写入CSV
+    with open(input_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+            open(output_file, 'w', encoding='utf-8', newline='') as out:
+        writer = csv.writer(out)
         # 写入表头
         writer.writerow(['Index', 'Token', 'Length'])
-        # 写入数据
-        writer.writerows(rows)
+        # 写入数据：第一个数字、引号中的内容、第二个数字
+        writer.writerows(
+            [m[1].decode(), m[2].decode('utf-8', 'replace'), m[3].decode()]
+            for m in _TOKEN_LINE_RE.finditer(mm)
+        )
 
 
 # 使用示例
@@ -43,4 +29,4 @@ if __name__ == "__main__":
         convert_token_file_to_csv(input_file, output_file)
         print(f"转换成功！结果已保存到 {output_file}")
     except Exception as e:
-        print(f"转换过程中出现错误: {str(e)}")
\ No newline at end of file
+        print(f"转换过程中出现错误: {str(e)}")
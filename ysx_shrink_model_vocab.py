@@ -1,6 +1,10 @@
 import argparse
 import ast
+import functools
 import math
+import mmap
+import os
+import re
 from pathlib import Path
 
 import torch
@@ -14,24 +18,42 @@ def safe_eval(s):
         return s
 
 
+# 词表行格式：索引 token字面量 长度
+_VOCAB_LINE_RE = re.compile(rb"(\d+) (.*) (\d+)\s*$")
+
+
+@functools.lru_cache(maxsize=None)
+def parse_token(literal):
+    """
+    解析字节形式的token字面量：不含转义的常见形式直接切片，其余交给safe_eval
+    新旧词表的token大多相同，缓存后第二次加载词表基本不再重复解析
+    """
+    if b"\\" not in literal and len(literal) >= 2:
+        quote = literal[-1:]
+        if literal[:1] == quote and quote in (b"'", b'"'):
+            return literal[1:-1].decode('utf-8')
+        if literal[:1] == b"b" and literal[1:2] == quote and quote in (b"'", b'"') and len(literal) >= 3:
+            return literal[2:-1]
+    return safe_eval(literal.decode('utf-8'))
+
+
 def load_vocab(vocab_file):
     """根据RWKV的tokenizer/rwkv_vocab_v20230424.txt的格式加载词表"""
     vocab = {}
-    with open(vocab_file, 'r', encoding='utf-8') as f:
-        for line_no, line in enumerate(f, 1):
+    if os.path.getsize(vocab_file) == 0:
+        return vocab
+    with open(vocab_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for line_no, line in enumerate(iter(mm.readline, b""), 1):
+            m = _VOCAB_LINE_RE.match(line)
+            if m is None:
+                if line.strip():
+                    print(f"警告：第{line_no}行格式不正确: {line.decode('utf-8', 'replace').strip()}")
+                continue
             try:
-                parts = line.strip().split(' ')
-                if len(parts) < 2:
-                    print(f"警告：第{line_no}行格式不正确: {line.strip()}")
-                    continue
-
                 # 第一个部分是索引，最后一个部分是长度
-                idx = int(parts[0])
-                token = ' '.join(parts[1:-1])
-                token = safe_eval(token)  # 使用更安全的eval
-                vocab[idx] = token
+                vocab[int(m[1])] = parse_token(m[2])
             except Exception as e:
-                print(f"警告：处理第{line_no}行时出错: {line.strip()}")
+                print(f"警告：处理第{line_no}行时出错: {line.decode('utf-8', 'replace').strip()}")
                 print(f"错误: {str(e)}")
                 continue
     return vocab
@@ -73,12 +95,12 @@ def convert_model_vocab(old_model_path, new_model_path, old_vocab_file, new_voca
     print(f"新词表大小: {len(new_vocab)}")
 
     # 创建token映射,保留0索引作为文档分隔符
+    old_token_to_idx = {token: idx for idx, token in old_vocab.items() if idx != 0}  # 跳过0索引
     token_mapping = {0: 0}  # 确保0索引映射到0
     token_mapping.update({
-        new_idx: old_idx
+        new_idx: old_token_to_idx[token]
         for new_idx, token in new_vocab.items()
-        for old_idx, old_token in old_vocab.items()
-        if token == old_token and new_idx != 0 and old_idx != 0  # 跳过0索引
+        if new_idx != 0 and token in old_token_to_idx
     })
 
     if len(token_mapping) != len(new_vocab) + 1:  # +1是因为要包含0索引
@@ -108,14 +130,11 @@ def convert_model_vocab(old_model_path, new_model_path, old_vocab_file, new_voca
     with torch.no_grad():
         new_emb.uniform_(-scale, scale)
 
-    # 复制已有的embedding,包括0索引
-    for new_idx, old_idx in token_mapping.items():
-        try:
-            new_emb[new_idx] = old_emb[old_idx]
-        except Exception as e:
-            print(f"警告：复制embedding时出错 new_idx={new_idx}, old_idx={old_idx}")
-            print(f"错误: {str(e)}")
-            continue
+    # 复制已有的embedding,包括0索引（一次 gather + scatter 完成所有行）
+    new_idx_t = torch.tensor(list(token_mapping.keys()), dtype=torch.long, device=old_emb.device)
+    old_idx_t = torch.tensor(list(token_mapping.values()), dtype=torch.long, device=old_emb.device)
+    with torch.no_grad():
+        new_emb.index_copy_(0, new_idx_t, old_emb.index_select(0, old_idx_t))
 
     model_state['emb.weight'] = new_emb
 
@@ -138,13 +157,8 @@ def convert_model_vocab(old_model_path, new_model_path, old_vocab_file, new_voca
         new_head.normal_(0, std)
 
     # 复制已有的输出层权重,包括0索引
-    for new_idx, old_idx in token_mapping.items():
-        try:
-            new_head[new_idx] = old_head[old_idx]
-        except Exception as e:
-            print(f"警告：复制输出层权重时出错 new_idx={new_idx}, old_idx={old_idx}")
-            print(f"错误: {str(e)}")
-            continue
+    with torch.no_grad():
+        new_head.index_copy_(0, new_idx_t.to(old_head.device), old_head.index_select(0, old_idx_t.to(old_head.device)))
 
     model_state['head.weight'] = new_head
 